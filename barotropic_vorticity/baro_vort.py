@@ -51,23 +51,75 @@ References:
 * McWilliams Initial Condition inspired by pyqg [https://github.com/pyqg/pyqg]
 """
 
+import multiprocessing
+import os
+import tempfile
+
 import numpy as np
 
 from numpy import pi, cos, sin
-from numpy.fft import fftshift, fftfreq
-from numpy.fft.fftpack import rfft2, irfft2
-
-# # if available, we will use pyFFTW for performing Fourier Transforms
-# try:
-#     import pyfftw
-#     from pyfftw.interfaces.numpy_fft import fftshift, fftn, ifftn
-#     pyfftw.interfaces.cache.enable()
-#     PYFFTW = True
-# except:
-#     print("WARNING: pyfftw not available.  Falling back to numpy")
-#     from numpy.fft import fftshift, fftfreq
-#     from numpy.fft.fftpack import rfft2, irfft2
-#     PYFFTW = False
+from numpy.fft import fftfreq, rfft2, irfft2
+
+from baro_vort_kernels import spectral_grad, ab3_update, jacobian, max_abs
+
+# FFTW planning: the model runs for many steps on a fixed grid, so the time
+# spent finding a fast plan is recovered quickly.  Plans found are kept as
+# wisdom on disk so later runs do not have to plan again.
+FFTW_FLAGS = ('FFTW_PATIENT', 'FFTW_DESTROY_INPUT')
+FFTW_THREADS = multiprocessing.cpu_count()
+FFTW_WISDOM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.fftw_wisdom.npz')
+
+# if available, we will use pyFFTW for performing Fourier Transforms
+try:
+    import pyfftw
+    pyfftw.config.NUM_THREADS = FFTW_THREADS
+    pyfftw.config.PLANNER_EFFORT = FFTW_FLAGS[0]
+    PYFFTW = True
+except ImportError:
+    print("WARNING: pyfftw not available.  Falling back to numpy")
+    PYFFTW = False
+
+def empty(shape, dtype=np.float64):
+    """Allocate a work array, SIMD aligned for FFTW when pyfftw is available."""
+    if PYFFTW:
+        return pyfftw.empty_aligned(shape, dtype=dtype)
+    return np.empty(shape, dtype=dtype)
+
+def zeros(shape, dtype=np.float64):
+    """Allocate a zeroed work array, aligned like empty()."""
+    a = empty(shape, dtype=dtype)
+    a[...] = 0
+    return a
+
+def load_wisdom(filename=FFTW_WISDOM):
+    """Import FFTW wisdom saved by a previous run, if there is any.
+    A missing or unreadable file is treated as having no wisdom."""
+    if not PYFFTW or not os.path.exists(filename):
+        return
+    try:
+        with np.load(filename, allow_pickle=False) as f:
+            wisdom = tuple(f['arr_%d' % i].tobytes() for i in range(len(f.files)))
+        pyfftw.import_wisdom(wisdom)
+    except Exception as e:
+        print("WARNING: could not load FFTW wisdom from %s: %s" % (filename, e))
+
+def save_wisdom(filename=FFTW_WISDOM):
+    """Save the FFTW wisdom accumulated so far.  The file is replaced
+    atomically, and failing to write it only gives a warning."""
+    if not PYFFTW:
+        return
+    wisdom = [np.frombuffer(w, dtype=np.uint8) for w in pyfftw.export_wisdom()]
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, *wisdom)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    except OSError as e:
+        print("WARNING: could not save FFTW wisdom to %s: %s" % (filename, e))
 
 def ft(phi):
     """Go from physical space to spectral space."""
@@ -77,11 +129,8 @@ def ift(psi):
     """Go from spectral space to physical space."""
     return irfft2(psi, axes=(-2,-1))
 
-
 class BarotropicVorticity(object):
     """A square domain barotropic vorticity model."""
-    _prhs = 0.0
-    _pprhs = 0.0
 
     def __init__(self,
         n,              # numerical resolution
@@ -123,67 +172,173 @@ class BarotropicVorticity(object):
         # The 2D Inverse transform returns a real-only domain (nx, ny)
         self.k = k = self.dk*np.arange(0, self.nk, dtype=np.float64)[np.newaxis, :]
         self.l = l = self.dl*fftfreq(self.nl, d=1.0/self.nl)[:, np.newaxis]
-
-
-        self.ksq = ksq = k**2 + l**2
-        self.ksq[ksq == 0] = 1.0             # avoid divide by zero - set ksq = 1 at zero wavenum
-        self.rksq = 1.0 / ksq                # reciprocal 1/(k^2 + l^2)
-
         self.ik = 1j*k                       # wavenumber mul. imaginary unit is useful
         self.il = 1j*l                       # for calculating derivatives
 
 
+        self.ksq = ksq = k**2 + l**2
+        with np.errstate(divide='ignore'):
+            self.rksq = 1.0 / ksq            # reciprocal 1/(k^2 + l^2)
+        self.rksq[0, 0] = 0.0                # the zero wavenumber is at [0, 0]: this gives
+                                             # ψ zero mean rather than dividing by zero
+
+        # k and l are kept in native FFT order, so the anti-alias mask can be
+        # made once here rather than on every step.  anti_alias() only
+        # touches the aliased modes through their flat indices.
+        k_mask = (8./9.)*(self.nk+1)**2.
+        aa_mask = ksq/(self.dk*self.dk) >= k_mask
+        self._aa_idx = np.flatnonzero(aa_mask)
+
         # Dissipation & Spectral Filters:
         # Use ∆^2n_diss hyperviscosity to diffuse at small scales (i.e. n_diss = 2 would be ∆^4)
         # use the x-dimension for reference scale values
         self.nu = ((L/(np.floor(n/3)*2.0*pi))**(2*n_diss))/tau
         self.n_diss = n_diss
 
-        self.t = 0.0                # time
-        self.tc = 0                 # step count
+        # High wavenumber filter of smith et al 2002.
+        filter_exp = 8.0
+        kcut = 30.0
+        filter_dec = -np.log(1.+2.*pi/self.nk)/((self.nk-kcut)**filter_exp)
+        K = np.sqrt(ksq/(self.dk*self.dk))
+        self._hwn_filter = np.where(K >= kcut, np.exp(filter_dec*(K-kcut)**filter_exp), 1.0)
 
-        # physical and transformed variables
-        self._z = np.zeros((self.nx,self.ny), dtype=np.float64)
-        self._zt = np.zeros((self.nl,self.nk), dtype=np.complex128)
+        # The high wavenumber filter and the anti-alias mask are both fixed,
+        # so fold them into one multiplier applied by the timestep update.
+        self._spectral_filter = np.where(aa_mask, 0.0, self._hwn_filter)
 
-        self.psi = np.zeros_like(self._z)
-        self.psit = np.zeros_like(self._zt)
+        # forcingt() excites the band of wavenumbers 14 < |K| < 20
+        self._forcing_idx = np.flatnonzero((14 < K) & (K < 20))
 
+        self.t = 0.0                # time
+        self.tc = 0                 # step count
 
-    def courant_number(self):
-        """Calculate the Courant Number given the velocity field and step size."""
-        u,v = self.velocity()
-        maxu = np.max(np.abs(u))
-        maxv = np.max(np.abs(v))
+        # physical and transformed variables
+        self._z = zeros((self.nx,self.ny), dtype=np.float64)
+        self._zt = zeros((self.nl,self.nk), dtype=np.complex128)
+
+        self._psi = zeros((self.nx,self.ny), dtype=np.float64)
+        self._psit = zeros((self.nl,self.nk), dtype=np.complex128)
+
+        # the physical fields and F[ψ] are only recomputed from the spectral
+        # state when they are read after a step, see the z, psi and psit
+        # properties
+        self._z_stale = False
+        self._psi_stale = False
+        self._psit_stale = False
+
+        # Work arrays, allocated once and overwritten on every step.
+        # rhs() fills the spectral derivatives (ψx, ψy, ζx, ζy) in _gradt,
+        # their physical values in _grad and the Jacobian in _jac and _jact.
+        # _rhs, _prhs and _pprhs hold the current and previous two right
+        # hand sides and are rotated by step().
+        spec, phys = (self.nl, self.nk), (self.ny, self.nx)
+        self._gradt = empty((4,) + spec, dtype=np.complex128)
+        self._grad = empty((4,) + phys)
+        self._uv = empty((2,) + phys)
+        self._jac = empty(phys)
+        self._jact = empty(spec, dtype=np.complex128)
+        self._rhs = np.zeros(spec, dtype=np.complex128)
+        self._prhs = np.zeros(spec, dtype=np.complex128)
+        self._pprhs = np.zeros(spec, dtype=np.complex128)
+        self._forcet = np.zeros(spec, dtype=np.complex128)
+
+        # FFTW plans are made once for the (ny, nx) <-> (nl, nk) transforms
+        # and bound to aligned buffers that are reused on every call.
+        # The four derivatives used by rhs() are transformed back to
+        # physical space together as a single (4, nl, nk) batch.
+        # Plans are looked up by the shape of the array to transform and
+        # kept with the output buffer they were planned with.
+        self._ffts = {}
+        self._iffts = {}
+        if PYFFTW:
+            load_wisdom()
+            wisdom = pyfftw.export_wisdom()
+            for batch in [(), (2,), (4,)]:
+                phi = empty(batch + phys)
+                phit = empty(batch + spec, dtype=np.complex128)
+                if not batch:
+                    self._ffts[phys] = (pyfftw.FFTW(phi, phit, axes=(-2, -1),
+                        direction='FFTW_FORWARD', flags=FFTW_FLAGS, threads=FFTW_THREADS),
+                        phit)
+                phi = empty(batch + phys)
+                self._iffts[phit.shape] = (pyfftw.FFTW(phit, phi, axes=(-2, -1),
+                    direction='FFTW_BACKWARD', flags=FFTW_FLAGS, threads=FFTW_THREADS),
+                    phi)
+            if pyfftw.export_wisdom() != wisdom:
+                save_wisdom()
+
+    def ft(self, phi, out=None):
+        """Go from physical space to spectral space."""
+        return self._transform(self._ffts, ft, phi, out)
+
+    def ift(self, psi, out=None):
+        """Go from spectral space to physical space."""
+        return self._transform(self._iffts, ift, psi, out)
+
+    def _transform(self, plans, fallback, a, out):
+        """Transform a with the FFTW plan for its shape, or with fallback
+        if there is none.  The result is written to out if given; when out
+        is laid out like the plan's own output the plan writes straight
+        into it rather than through a copy."""
+        if a.shape not in plans:
+            res = fallback(a)
+            if out is None:
+                return res
+            out[:] = res
+            return out
+        plan, res = plans[a.shape]
+        target = out if self._can_bind(plan, res, out) else res
+        plan.input_array[:] = a
+        plan.update_arrays(plan.input_array, target)
+        plan()
+        if out is None:
+            return res.copy()
+        if target is not out:
+            out[:] = res
+        return out
+
+    @staticmethod
+    def _can_bind(plan, res, out):
+        """Can out be used as the output array of plan in place of res?"""
+        return (out is not None and out.dtype == res.dtype
+                and out.shape == res.shape and out.strides == res.strides
+                and pyfftw.is_byte_aligned(out, plan.output_alignment))
+
+
+    def courant_number(self, u=None, v=None):
+        """Calculate the Courant Number given the velocity field and step size.
+        If (u, v) are not given they are calculated from F[ψ]."""
+        if u is None or v is None:
+            u,v = self.velocity(out=self._uv)
+        maxu, maxv = max_abs(u, v)
         maxvel = maxu + maxv
         return maxvel*self.dt/self.dx
 
-    def grad(self, phit):
+    def grad(self, phit, out=None):
         """Returns the spatial derivatives of a Fourier transformed variable.
         Returns (∂/∂x[F[φ]], ∂/∂y[F[φ]]) i.e. (ik F[φ], il F[φ])"""
-        phixt = self.ik*phit        # d/dx F[φ] = ik F[φ]
-        phiyt = self.il*phit        # d/dy F[φ] = il F[φ]
+        if out is None:
+            out = np.empty((2,) + phit.shape, dtype=np.complex128)
+        phixt, phiyt = out
+        np.multiply(phit, self.ik, out=phixt)   # d/dx F[φ] = ik F[φ]
+        np.multiply(phit, self.il, out=phiyt)   # d/dy F[φ] = il F[φ]
         return (phixt, phiyt)
 
-    def velocity(self):
+    def velocity(self, out=None):
         """Returns the velocity field (u, v) from F[ψ]."""
-        psixt, psiyt = self.grad(self.psit)
-        psix = ift(psixt)    # v =   ∂/∂x[ψ]
-        psiy = ift(psiyt)    # u = - ∂/∂y[ψ]
-        return (-psiy, psix)
+        gradt = self._gradt[:2]
+        self.grad(self.psit, out=gradt)
+        psix, psiy = self.ift(gradt, out=out)   # v =   ∂/∂x[ψ]
+        np.negative(psiy, out=psiy)             # u = - ∂/∂y[ψ]
+        return (psiy, psix)
 
     def anti_alias(self, phit):
         """Set the coefficients of wavenumbers > k_mask to be zero."""
-        k_mask = (8./9.)*(self.nk+1)**2.
-        phit[(np.abs(self.ksq/(self.dk*self.dk)) >= k_mask)] = 0.0
+        phit.flat[self._aa_idx] = 0.0
 
     def high_wn_filter(self, phit):
         """Applies the high wavenumber filter of smith et al 2002"""
-        filter_exp = 8.0
-        kcut = 30.0
-        filter_dec = -np.log(1.+2.*pi/self.nk)/((self.nk-kcut)**filter_exp)
-        filter_idx = np.abs(self.ksq/(self.dk*self.dk)) >= kcut**2.
-        phit[filter_idx] *= np.exp(filter_dec*(np.sqrt(self.ksq[filter_idx]/(self.dk*self.dk))-kcut)**filter_exp)
+        phit *= self._hwn_filter
 
     @property
     def zt(self):
@@ -193,44 +348,69 @@ class BarotropicVorticity(object):
     def zt(self, value):
         # set the transformed value of zeta
         self._zt[:] = value
-        # update physical zeta and other dependents
-        self._z[:] = ift(value)
+        # physical zeta is updated when it is next needed
+        self._z_stale = True
         self._update_psi()
 
     @property
     def z(self):
+        if self._z_stale:
+            self.ift(self._zt, out=self._z)
+            self._z_stale = False
         return self._z
 
     @z.setter
     def z(self, value):
         self._z[:] = value
-        self._zt[:] = ft(value)
+        self._z_stale = False
+        self.ft(value, out=self._zt)
         self._update_psi()
 
+    @property
+    def psit(self):
+        if self._psit_stale:
+            np.multiply(self._zt, self.rksq, out=self._psit)
+            np.negative(self._psit, out=self._psit)   # F[ψ] = - F[ζ] / (k^2 + l^2)
+            self._psit_stale = False
+        return self._psit
+
+    @property
+    def psi(self):
+        if self._psi_stale:
+            self.ift(self.psit, out=self._psi)
+            self._psi_stale = False
+        return self._psi
+
     def _update_psi(self):
-        """After z or zt have changed, update the streamfunction."""
-        self.psit[:] = -self.rksq * self._zt     # F[ψ] = - F[ζ] / (k^2 + l^2)
-        self.psi[:] = ift(self.psit)
+        """After z or zt have changed, mark the streamfunction as stale.
+        step() never reads F[ψ] (spectral_grad forms it on the fly), so it
+        is only computed when psit, psi or velocity() ask for it."""
+        self._psit_stale = True
+        self._psi_stale = True
 
 
     def step(self):
         """Take a single step forward in time using Adams-Bashforth 3."""
         dt = self.dt
 
-        # calculate the size of timestep that can be taken
-        c = self.courant_number()
+        rhs = self.rhs()
+
+        # calculate the size of timestep that can be taken,
+        # reusing the velocities already found by rhs(): u = -ψy, v = ψx
+        psix, psiy = self._grad[:2]
+        c = self.courant_number(psiy, psix)
         if c >= 0.8:
             print('DEBUG: Courant No > 0.8, reducing timestep')
             dt = 0.9*dt
         elif c < 0.4:
             dt = 1.1*dt
 
-        if self.tc is 0:
+        if self.tc == 0:
             # forward euler
             dt1 = dt
             dt2 = 0.0
             dt3 = 0.0
-        elif self.tc is 1:
+        elif self.tc == 1:
             # AB2 at step 2
             dt1 = 1.5*dt
             dt2 = -0.5*dt
@@ -241,19 +421,18 @@ class BarotropicVorticity(object):
             dt2 = -16./12.*dt
             dt3 = 5./12.*dt
 
-        rhs = self.rhs()
-        newzt = self.zt + dt1*rhs + dt2*self._prhs + dt3*self._pprhs
-        self._pprhs = self._prhs
-        self._prhs  = rhs
-
         # apply hyperviscosity
         #deln = 1.0 / (1.0 + self.nu*self.ksq**self.n_diss*dt)
         #newzt = newzt*deln
-        self.high_wn_filter(newzt)
-        self.anti_alias(newzt)
-
-        # update the state
-        self.zt = newzt
+        # the high wavenumber filter and anti-aliasing are applied as part
+        # of the update through self._spectral_filter
+        ab3_update(self._zt, rhs, self._prhs, self._pprhs,
+                   dt1, dt2, dt3, self._spectral_filter, self._zt)
+        self._rhs, self._prhs, self._pprhs = self._pprhs, self._rhs, self._prhs
+
+        # zt was updated in place, so references to self.zt stay current
+        self._z_stale = True
+        self._update_psi()
         self.tc = self.tc + 1
         self.t = self.t + dt
 
@@ -264,27 +443,25 @@ class BarotropicVorticity(object):
     def forcingt(self):
         """Apply a forcing in spectral space."""
         amp = 0.01
-        forcet = np.zeros_like(self.zt)
-        K = np.sqrt(self.ksq)/self.dk
-        idx = (14 < K) & (K < 20)
-        forcet[idx] = amp*0.5*(np.random.random(forcet.shape)[idx] - 0.5)*np.exp(1j*2.*pi*np.random.random(forcet.shape)[idx])
+        forcet = self._forcet
+        idx = self._forcing_idx
+        forcet.flat[idx] = amp*0.5*(np.random.random(idx.size) - 0.5)*np.exp(1j*2.*pi*np.random.random(idx.size))
         return 0.0
 
     def rhs(self):
+        """Returns the tendency of F[ζ].  The result is written to a work
+        array that is reused by later steps."""
         # calculate derivatives in spectral space
-        psixt, psiyt = self.grad(self.psit)
-        zxt, zyt = self.grad(self.zt)
+        psixt, psiyt, zxt, zyt = self._gradt
+        spectral_grad(self._zt, self.rksq, self.ik, self.il, psixt, psiyt, zxt, zyt)
 
         # transform back to physical space for pseudospectral part
-        psix = ift(psixt)
-        psiy = ift(psiyt)
-        zx =   ift(zxt)
-        zy =   ift(zyt)
+        psix, psiy, zx, zy = self.ift(self._gradt, out=self._grad)
 
         # Non-linear: calculate the Jacobian in real space
         # and then transform back to spectral space
-        jac = psix * zy - psiy * zx + self.ubar * zx
-        jact = ft(jac)
+        jacobian(psix, zy, psiy, zx, self.ubar, self._jac)
+        jact = self.ft(self._jac, out=self._jact)
 
         force = self.forcing()
         forcet = self.forcingt()
@@ -292,13 +469,19 @@ class BarotropicVorticity(object):
             forcet = 0.0
 
         if force is not None:
-            forcet = forcet + ft(force)
+            forcet = forcet + self.ft(force)
 
-        rhs = -jact - self.beta*psixt + forcet
+        rhs = self._rhs
+        np.multiply(psixt, -self.beta, out=rhs)
+        rhs -= jact
+        rhs += forcet
         return rhs
 
 if __name__ == '__main__':
-    bv = BarotropicVorticity(n=256, ubar=0.00, beta=8.0)
+    import sys
+    # resolution can be given on the command line, e.g. `python baro_vort.py 128`
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    bv = BarotropicVorticity(n=n, ubar=0.00, beta=8.0)
     # The McWilliams Initial Condition from [McWilliams - J. Fluid Mech. (1984)]
     ksq = bv.ksq
     ck = np.zeros_like(ksq)
@@ -316,15 +499,15 @@ if __name__ == '__main__':
 
     # single spot of max val 2.0 in lower half of plane
     # d = int(bv.z.shape[0] / 4.0)
-    # i, j = np.indices(bv.z.shape)
-    # ppxy = np.abs(d - i)**2 + np.abs(d*2 - j)**2
-    # dist = np.sqrt(ppxy)
+    # i, j = np.ogrid[:bv.ny, :bv.nx]
+    # dist = np.sqrt((d - i)**2 + (d*2 - j)**2)
     # bv.z = np.exp(-(dist)/40)
 
     # PLOT
-    import time
-    import matplotlib
+    # Redrawing is slow compared to a model step, so only plot every
+    # plot_every steps and let the GUI redraw when it is idle.
     import matplotlib.pyplot as plt
+    plot_every = 10
     fig = plt.figure()
     ax = fig.add_subplot(111)
     im = ax.imshow(bv.z, cmap=plt.cm.seismic,origin='lower')
@@ -334,8 +517,10 @@ if __name__ == '__main__':
 
     for i in range(1000):
         bv.step()
-        im.set_data(bv.z)
-        im.set_clim(bv.z.min(), bv.z.max())
-        im.axes.figure.canvas.draw()
-        plt.pause(0.001)
-        print(bv.tc)
\ No newline at end of file
+        print(bv.tc)
+        if bv.tc % plot_every == 0:
+            z = bv.z
+            im.set_data(z)
+            im.set_clim(z.min(), z.max())
+            fig.canvas.draw_idle()
+            plt.pause(0.001)
@@ -55,8 +55,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from numpy import pi, cos, sin
-from numpy.fft import fftshift, fftfreq
-from numpy.fft.fftpack import rfft2, irfft2
+from numpy.fft import fftshift, fftfreq, rfft2, irfft2
 
 
 ### Configuration
@@ -119,7 +118,7 @@ def velocity(psit):
 
 def spectral_variance(phit):
     global nx, ny
-    var_density = 2.0 * np.abs(phit)**2 / (nx*ny)
+    var_density = 2.0 * (phit.real**2 + phit.imag**2) / (nx*ny)
     var_density[:,0] /= 2
     var_density[:,-1] /= 2
     return var_density.sum()
@@ -144,12 +143,12 @@ _prhs, _pprhs  = 0.0, 0.0  # previous two right hand sides
 def adams_bashforth(zt, rhs, dt):
     """Take a single step forward in time using Adams-Bashforth 3."""
     global step, t, _prhs, _pprhs
-    if step is 0:
+    if step == 0:
         # forward euler
         dt1 = dt
         dt2 = 0.0
         dt3 = 0.0
-    elif step is 1:
+    elif step == 1:
         # AB2 at step 2
         dt1 = 1.5*dt
         dt2 = -0.5*dt
@@ -169,7 +168,7 @@ def adams_bashforth(zt, rhs, dt):
 
 ### Physical Domain
 nl = ny
-nk = nx/2 + 1
+nk = nx//2 + 1
 dx = Lx / nx
 dy = Ly / ny
 dt = 0.4 * 16.0 / nx          # choose an initial dt. This will change
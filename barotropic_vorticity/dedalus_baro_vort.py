@@ -157,7 +157,7 @@ print(piit.shape)
 
 def spectral_variance(phit):
     global nx, ny
-    var_density = 2.0 * np.abs(phit)**2 / (nx*ny)
+    var_density = 2.0 * (phit.real**2 + phit.imag**2) / (nx*ny)
     var_density[:,0] /= 2
     var_density[:,-1] /= 2
     return var_density.sum()
@@ -19,7 +19,7 @@ ksq = k**2 + l**2
 # initial_grid = initial_grid - initial_grid.mean()
 
 def spectral_variance(phit, n=N):
-    var_density = 2.0 * np.abs(phit)**2 / (n*n)
+    var_density = 2.0 * (phit.real**2 + phit.imag**2) / (n*n)
     var_density[:,0] /= 2
     var_density[:,-1] /= 2
     return var_density.sum()